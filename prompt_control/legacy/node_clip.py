@@ -1,12 +1,28 @@
+import contextlib
+import hashlib
+import heapq
+import importlib.util
+import itertools
+import json
 import logging
 import re
+import weakref
 import torch
 from ..parser import parse_prompt_schedules, parse_cuts
-from .utils import Timer, equalize, apply_loras_from_spec
+from .utils import (
+    BF16_ENCODE,
+    Timer,
+    DiskCondCache,
+    LRUCache,
+    equalize,
+    pin_conds,
+    tokenize,
+    apply_loras_from_spec,
+)
 from ..utils import safe_float, get_function, parse_floats  # non-legacy
 from .perp_weight import perp_encode
 from comfy_extras.nodes_mask import FeatherMask, MaskComposite
-from node_helpers import conditioning_set_values
+import comfy.model_management
 
 
 log = logging.getLogger("comfyui-prompt-control-legacy")
@@ -38,10 +54,16 @@ except ImportError:
 
 
 AVAILABLE_STYLES.append("perp")
+STYLES = frozenset(AVAILABLE_STYLES)
+NORMALIZATIONS = frozenset(AVAILABLE_NORMALIZATIONS)
 log.info("Use STYLE(weight_interpretation, normalization) at the start of a prompt to use advanced encodings")
 log.info("Weight interpretations available: %s", ",".join(AVAILABLE_STYLES))
 log.info("Normalization types available: %s", ",".join(AVAILABLE_NORMALIZATIONS))
 
+AND_RE = re.compile(r"\bAND\b")
+BREAK_RE = re.compile(r"\bBREAK\b")
+WEIGHT_RE = re.compile(r":(-?\d\.?\d*)(![A-Za-z]+)?$")
+
 
 def linear_interpolate_cond(
     start, end, from_step=0.0, to_step=1.0, step=0.1, start_at=None, end_at=None, prompt_start="N/A", prompt_end="N/A"
@@ -57,7 +79,6 @@ def linear_interpolate_cond(
 
     all_res = []
     for idx in range(count):
-        res = []
         from_cond, to_cond = equalize(start[idx][0], end[idx][0])
         from_pooled = start[idx][1].get("pooled_output")
         to_pooled = end[idx][1].get("pooled_output")
@@ -71,47 +92,67 @@ def linear_interpolate_cond(
             f"interpolate_cond {idx=} {from_step=} {to_step=} {start_at=} {end_at=} {total_steps=} {num_steps=} {start_on=} {step=}"
         )
         x = 1 / (total_steps + 1)
-        for s in range(start_on, num_steps):
-            factor = round((s + 1) * x, 2)
-            new_cond = from_cond + (to_cond - from_cond) * factor
-            if from_pooled is not None and to_pooled is not None:
-                from_pooled, to_pooled = equalize(from_pooled, to_pooled)
-                new_pooled = from_pooled + (to_pooled - from_pooled) * factor
-            elif from_pooled is not None:
-                new_pooled = from_pooled
-
-            n = [new_cond, start[idx][1].copy()]
-            if new_pooled is not None:
-                n[1]["pooled_output"] = new_pooled
-            n[1]["start_percent"] = round(start_pct, 2)
-            n[1]["end_percent"] = min(round((start_pct + step), 2), 1.0)
-            start_pct += step
-            start_pct = round(start_pct, 2)
-            if prompt_start:
-                n[1]["prompt"] = f"linear:{round(1.0 - factor, 2)} / {factor}"
-            log.debug(
-                "Interpolating at step %s with factor %s (%s, %s)...",
-                s,
-                factor,
-                n[1]["start_percent"],
-                n[1]["end_percent"],
+        factors = [round((s + 1) * x, 2) for s in range(start_on, num_steps)]
+        if not factors:
+            continue
+        # Interpolate all steps at once instead of doing one small operation per step
+        f = torch.tensor(factors, dtype=from_cond.dtype, device=from_cond.device)
+        new_conds = torch.lerp(from_cond.unsqueeze(0), to_cond.unsqueeze(0), f.view(-1, *[1] * from_cond.dim()))
+        new_pooleds = None
+        if from_pooled is not None and to_pooled is not None:
+            from_pooled, to_pooled = equalize(from_pooled, to_pooled)
+            f = f.to(from_pooled)
+            new_pooleds = torch.lerp(
+                from_pooled.unsqueeze(0), to_pooled.unsqueeze(0), f.view(-1, *[1] * from_pooled.dim())
             )
-            res.append(n)
-        if res:
-            res[-1][1]["end_percent"] = round(end_at, 2)
-            all_res.extend(res)
+        pooleds = new_pooleds if new_pooleds is not None else [from_pooled] * len(factors)
+
+        pcts = []
+        for _ in factors:
+            pcts.append(start_pct)
+            start_pct = round(start_pct + step, 2)
+        start_pcts = [round(p, 2) for p in pcts]
+        end_pcts = [min(round(p + step, 2), 1.0) for p in pcts]
+        end_pcts[-1] = round(end_at, 2)
+        log.debug(
+            "Interpolating steps %s to %s with factors %s (%s, %s)...",
+            start_on,
+            num_steps,
+            factors,
+            start_pcts,
+            end_pcts,
+        )
+
+        base_settings = {k: v for k, v in start[idx][1].items() if k != "pooled_output"}
+        for i, factor in enumerate(factors):
+            settings = {**base_settings, "start_percent": start_pcts[i], "end_percent": end_pcts[i]}
+            if pooleds[i] is not None:
+                settings["pooled_output"] = pooleds[i]
+            if prompt_start:
+                settings["prompt"] = f"linear:{round(1.0 - factor, 2)} / {factor}"
+            all_res.append([new_conds[i], settings])
     return all_res
 
 
 def get_control_points(schedule, steps, encoder):
     assert len(steps) > 1
-    new_steps = set(steps)
-
-    for step in (s[0] for s in schedule if s[0] >= steps[0] and s[0] <= steps[-1]):
-        new_steps.add(step)
-    control_points = [(s, encoder(schedule.at_step(s)[1])) for s in new_steps]
+    # Both steps and the schedule are sorted, so merging keeps the result sorted
+    schedule_steps = (s[0] for s in schedule if s[0] >= steps[0] and s[0] <= steps[-1])
+    new_steps = []
+    for step in heapq.merge(steps, schedule_steps):
+        if not new_steps or new_steps[-1] != step:
+            new_steps.append(step)
+
+    # Adjacent steps often map to the same prompt, only encode each one once
+    encoded = {}
+    control_points = []
+    for s in new_steps:
+        idx, p = schedule.at_step_idx(s)
+        if idx not in encoded:
+            encoded[idx] = encoder(p[1])
+        control_points.append((s, encoded[idx]))
     log.debug("Actual control points for interpolation: %s (from %s)", new_steps, steps)
-    return sorted(control_points, key=lambda x: x[0])
+    return control_points
 
 
 def linear_interpolator(control_points, step, start_pct, end_pct):
@@ -203,11 +244,11 @@ def get_style(text, default_style="comfy", default_normalization="none"):
     style, normalization = styles[0]
     style = style.strip()
     normalization = normalization.strip()
-    if style not in AVAILABLE_STYLES:
+    if style not in STYLES:
         log.warning("Unrecognized prompt style: %s. Using %s", style, default_style)
         style = default_style
 
-    if normalization not in AVAILABLE_NORMALIZATIONS:
+    if normalization not in NORMALIZATIONS:
         log.warning("Unrecognized prompt normalization: %s. Using %s", normalization, default_normalization)
         normalization = default_normalization
 
@@ -304,7 +345,37 @@ def fix_word_ids(tokens):
     return tokens
 
 
-def encode_prompt(clip, text, default_style="comfy", default_normalization="none"):
+ENCODE_CACHE = weakref.WeakKeyDictionary()
+
+
+def use_bf16_autocast(clip):
+    device = clip.patcher.load_device
+    # Only use bf16 when the load device supports it natively, not through emulation
+    return BF16_ENCODE and device.type == "cuda" and comfy.model_management.should_use_bf16(device)
+
+
+def encode_prompt(clip, text, default_style="comfy", default_normalization="none", clip_key=None):
+    """clip_key is a tuple of (unpatched CLIP object, LoRA spec string) identifying the state of clip.
+    If given, results are cached for the lifetime of the process"""
+    if clip_key is None:
+        return _encode_prompt(clip, text, default_style, default_normalization)
+
+    def clone(r):
+        return tuple(t.clone() if t is not None else None for t in r)
+
+    orig_clip, loras = clip_key
+    cache = ENCODE_CACHE.setdefault(orig_clip, LRUCache(256))
+    key = (loras, text, default_style, default_normalization)
+    r = cache.get(key)
+    if r is None:
+        r = _encode_prompt(clip, text, default_style, default_normalization)
+        cache.put(key, clone(r))
+        return r
+    # Cached tensors end up in node outputs, so never hand them out directly
+    return clone(r)
+
+
+def _encode_prompt(clip, text, default_style, default_normalization):
     style, normalization, text = get_style(text, default_style, default_normalization)
     sculpts = []
     if can_sculpt:
@@ -312,11 +383,16 @@ def encode_prompt(clip, text, default_style="comfy", default_normalization="none
     text, regions = parse_cuts(text)
     # defaults=None means there is no argument parsing at all
     text, l_prompts = get_function(text, "CLIP_L", defaults=None)
-    chunks = re.split(r"\bBREAK\b", text)
+    chunks = BREAK_RE.split(text)
     token_chunks = []
     need_word_ids = len(regions) > 0 or (have_advanced_encode and style != "perp")
     for c in chunks:
-        c, shuffles = get_function(c.strip(), "(SHIFT|SHUFFLE)", ["0", "default", "default"], return_func_name=True)
+        c = c.strip()
+        # Empty chunks are common around stacked BREAKs and need no processing
+        if not c and not sculpts:
+            token_chunks.append(tokenize(clip, "", return_word_ids=need_word_ids))
+            continue
+        c, shuffles = get_function(c, "(SHIFT|SHUFFLE)", ["0", "default", "default"], return_func_name=True)
         r = c
         for s in shuffles:
             r = shuffle_chunk(s, r)
@@ -330,26 +406,24 @@ def encode_prompt(clip, text, default_style="comfy", default_normalization="none
             t = vector_sculptor_tokens(clip, c, method, norm, w)
         else:
             # Tokenizer returns padded results
-            t = clip.tokenize(c, return_word_ids=need_word_ids)
+            t = tokenize(clip, c, return_word_ids=need_word_ids)
         token_chunks.append(t)
-    tokens = token_chunks[0]
-
-    for key in tokens:
-        for c in token_chunks[1:]:
-            tokens[key].extend(c[key])
+    tokens = {key: list(itertools.chain.from_iterable(c[key] for c in token_chunks)) for key in token_chunks[0]}
 
     # Non-SDXL has only "l"
     if "g" in tokens and l_prompts:
         text_l = " ".join(l_prompts)
         log.info("Encoded SDXL CLIP_L prompt: %s", text_l)
-        tokens["l"] = clip.tokenize(text_l, return_word_ids=need_word_ids)["l"]
+        tokens["l"] = tokenize(clip, text_l, return_word_ids=need_word_ids)["l"]
 
     if "g" in tokens and "l" in tokens and len(tokens["l"]) != len(tokens["g"]):
-        empty = clip.tokenize("", return_word_ids=need_word_ids)
-        while len(tokens["l"]) < len(tokens["g"]):
-            tokens["l"] += empty["l"]
-        while len(tokens["l"]) > len(tokens["g"]):
-            tokens["g"] += empty["g"]
+        # The empty prompt tokenizes to a single padding chunk
+        empty = tokenize(clip, "", return_word_ids=need_word_ids)
+        diff = len(tokens["g"]) - len(tokens["l"])
+        if diff > 0:
+            tokens["l"] += empty["l"] * diff
+        else:
+            tokens["g"] += empty["g"] * -diff
 
     tokens = fix_word_ids(tokens)
 
@@ -366,25 +440,33 @@ def encode_prompt(clip, text, default_style="comfy", default_normalization="none
             embs_l = None
             embs_g = None
             pooled = None
-            if "l" in tokens:
-                embs_l, _ = advanced_encode_from_tokens(
-                    tokens["l"],
-                    normalization,
-                    style,
-                    lambda x: encode_token_weights(clip, x, encode_token_weights_l),
-                    return_pooled=False,
-                )
-            if "g" in tokens:
-                embs_g, pooled = advanced_encode_from_tokens(
-                    tokens["g"],
-                    normalization,
-                    style,
-                    lambda x: encode_token_weights(clip, x, encode_token_weights_g),
-                    return_pooled=True,
-                    apply_to_pooled=False,
-                )
-            # Hardcoded clip_balance
-            return prepareXL(embs_l, embs_g, pooled, 0.5)
+            bf16 = use_bf16_autocast(clip)
+            if bf16:
+                # Load and patch the model first so that LoRA weights aren't merged under autocast
+                comfy.model_management.load_model_gpu(clip.patcher)
+            with torch.autocast(device_type="cuda", dtype=torch.bfloat16) if bf16 else contextlib.nullcontext():
+                if "l" in tokens:
+                    embs_l, _ = advanced_encode_from_tokens(
+                        tokens["l"],
+                        normalization,
+                        style,
+                        lambda x: encode_token_weights(clip, x, encode_token_weights_l),
+                        return_pooled=False,
+                    )
+                if "g" in tokens:
+                    embs_g, pooled = advanced_encode_from_tokens(
+                        tokens["g"],
+                        normalization,
+                        style,
+                        lambda x: encode_token_weights(clip, x, encode_token_weights_g),
+                        return_pooled=True,
+                        apply_to_pooled=False,
+                    )
+                # Hardcoded clip_balance
+                cond, pooled = prepareXL(embs_l, embs_g, pooled, 0.5)
+            if bf16:
+                cond, pooled = cond.float(), pooled.float()
+            return cond, pooled
         return advanced_encode_from_tokens(
             tokens["l"],
             normalization,
@@ -456,9 +538,10 @@ def make_mask(args, size, weight):
             f"MASK specified with invalid size {x1} {x2}, {y1} {y2}. They must either all be percentages between 0 and 1 or positive integer pixel values excluding 1"
         )
 
-    mask = torch.full((h, w), 0, dtype=torch.float32, device="cpu")
-    mask[ys[0] : ys[1], xs[0] : xs[1]] = weight
-    mask = mask.unsqueeze(0)
+    # Masks stay on the CPU since they get combined with input masks and ComfyUI's mask nodes
+    mask = torch.zeros((1, h, w), dtype=torch.float32, device="cpu")
+    if weight:
+        mask[:, ys[0] : ys[1], xs[0] : xs[1]] = weight
     log.info("Mask xs=%s, ys=%s, shape=%s, weight=%s", xs, ys, mask.shape, weight)
     return mask
 
@@ -544,12 +627,18 @@ def apply_noise(cond, weight, gen):
     if cond is None or not weight:
         return cond
 
-    n = torch.randn(cond.size(), generator=gen).to(cond)
+    if gen is None:
+        n = torch.randn_like(cond)
+    else:
+        # Seeded noise must come from the CPU generator so that results stay the same.
+        # Generate it in pinned memory so that the copy to the GPU doesn't block
+        pin = cond.device.type == "cuda"
+        n = torch.empty(cond.size(), pin_memory=pin).normal_(generator=gen).to(cond, non_blocking=pin)
 
-    return cond * (1 - weight) + n * weight
+    return torch.lerp(cond, n, weight)
 
 
-def do_encode(clip, text, defaults, masks):
+def do_encode(clip, text, defaults, masks, clip_key=None):
     # First style modifier applies to ANDed prompts too unless overridden
     style, normalization, text = get_style(text)
     text, mask_size = get_mask_size(text, defaults)
@@ -558,14 +647,14 @@ def do_encode(clip, text, defaults, masks):
     alt_method = "COMFYAND()" in text
     text = text.replace("COMFYAND()", "")
 
-    prompts = [p.strip() for p in re.split(r"\bAND\b", text)]
+    prompts = [p.strip() for p in AND_RE.split(text)]
 
     p, sdxl_opts = get_sdxl(prompts[0], defaults)
     prompts[0] = p
 
     def weight(t):
         opts = {}
-        m = re.search(r":(-?\d\.?\d*)(![A-Za-z]+)?$", t)
+        m = WEIGHT_RE.search(t)
         if not m:
             return (1.0, opts, t)
         w = float(m[1])
@@ -576,18 +665,30 @@ def do_encode(clip, text, defaults, masks):
 
         return w, opts, t
 
+    def parse(i, p):
+        prompt, mask, mask_weight = get_mask(p, mask_size, masks)
+        w, opts, prompt = weight(prompt)
+        area = None
+        local_sdxl_opts = {}
+        if w:
+            prompt, area = get_area(prompt)
+            # SDXL() in the first prompt has already been parsed into sdxl_opts
+            if i > 0:
+                prompt, local_sdxl_opts = get_sdxl(prompt, defaults)
+        # AREA and MASK prompts don't count towards the scale
+        scaled = not ("AREA(" in p or "MASK(" in p)
+        return prompt, mask, mask_weight, w, opts, area, local_sdxl_opts, scaled
+
+    parsed = [parse(i, p) for i, p in enumerate(prompts)]
+
     conds = []
     res = []
-    scale = sum(abs(weight(p)[0]) for p in prompts if not ("AREA(" in p or "MASK(" in p))
-    for prompt in prompts:
-        prompt, mask, mask_weight = get_mask(prompt, mask_size, masks)
-        w, opts, prompt = weight(prompt)
+    scale = sum(abs(r[3]) for r in parsed if r[7])
+    for prompt, mask, mask_weight, w, opts, area, local_sdxl_opts, _ in parsed:
         text, noise_w, generator = get_noise(text)
         if not w:
             continue
-        prompt, area = get_area(prompt)
-        prompt, local_sdxl_opts = get_sdxl(prompt, defaults)
-        cond, pooled = encode_prompt(clip, prompt, style, normalization)
+        cond, pooled = encode_prompt(clip, prompt, style, normalization, clip_key)
         cond = apply_noise(cond, noise_w, generator)
         pooled = apply_noise(pooled, noise_w, generator)
 
@@ -618,8 +719,8 @@ def do_encode(clip, text, defaults, masks):
     if len(res) > 0:
         opts = sdxl_opts
         if pooleds:
-            opts["pooled_output"] = sum(equalize(*pooleds))
-        sumcond = sum(equalize(*sumconds))
+            opts["pooled_output"] = torch.stack(equalize(*pooleds)).sum(0)
+        sumcond = torch.stack(equalize(*sumconds)).sum(0)
         conds.append([sumcond, opts])
     return conds
 
@@ -634,18 +735,85 @@ def debug_conds(conds):
     return r
 
 
+def have_cutoff():
+    try:
+        return importlib.util.find_spec("custom_nodes.ComfyUI_Cutoff") is not None
+    except ImportError:
+        return False
+
+
+FINGERPRINT_CACHE = weakref.WeakKeyDictionary()
+
+
+def clip_fingerprint(clip):
+    """Identifies a CLIP model and its patches across processes for the disk cond cache.
+    Computed once per CLIP object"""
+    fingerprint = FINGERPRINT_CACHE.get(clip)
+    if fingerprint is None:
+        fingerprint = FINGERPRINT_CACHE[clip] = _clip_fingerprint(clip)
+    return fingerprint
+
+
+def _clip_fingerprint(clip):
+    h = hashlib.blake2b(type(clip.cond_stage_model).__name__.encode())
+    sums = {}
+
+    def update(x):
+        # Hash shapes and cheap sums of tensors, recursing into LoRA patch data
+        if isinstance(x, torch.Tensor):
+            h.update(f"{tuple(x.shape)}{x.dtype}".encode())
+            sums.setdefault(x.device, []).append(x.detach().float().sum())
+        elif isinstance(x, (tuple, list)):
+            h.update(f"{type(x).__name__}{len(x)}".encode())
+            for y in x:
+                update(y)
+        elif hasattr(x, "weights"):
+            h.update(type(x).__name__.encode())
+            update(x.weights)
+        elif callable(x):
+            # The default repr contains a memory address
+            h.update(getattr(x, "__qualname__", type(x).__name__).encode())
+        else:
+            h.update(repr(x).encode())
+
+    # ComfyUI patches weights in place, so use the backed up original for any patched weight
+    backup = getattr(clip.patcher, "backup", {})
+    sd = clip.cond_stage_model.state_dict()
+    for k in sorted(sd.keys()):
+        h.update(k.encode())
+        w = backup.get(k, sd[k])
+        update(getattr(w, "weight", w))
+    patches = getattr(clip.patcher, "patches", {})
+    for k in sorted(patches.keys()):
+        h.update(str(k).encode())
+        update(patches[k])
+    # Only one sync per device
+    for device in sorted(sums.keys(), key=str):
+        h.update(str(torch.stack(sums[device]).tolist()).encode())
+    # CLIP skip and tokenizer options are stored on the CLIP object, not in the model
+    h.update(repr(getattr(clip, "layer_idx", None)).encode())
+    h.update(repr(sorted(getattr(clip, "tokenizer_options", {}).items())).encode())
+    # Available extensions change how prompts get encoded
+    h.update(repr((sorted(STYLES), sorted(NORMALIZATIONS), can_sculpt, have_cutoff())).encode())
+    h.update(f"bf16={BF16_ENCODE}".encode())
+    return h.digest()
+
+
 def control_to_clip_common(clip, schedules, lora_cache=None, cond_cache=None):
+    input_clip = clip
     orig_clip = clip.clone()
     current_loras = {}
     if lora_cache is None:
         lora_cache = {}
     start_pct = 0.0
     conds = []
-    cond_cache = cond_cache if cond_cache is not None else {}
+    defaults = json.dumps(schedules.defaults, sort_keys=True, default=str).encode()
+    cond_cache = DiskCondCache(
+        cond_cache if cond_cache is not None else {}, lambda: clip_fingerprint(input_clip) + defaults
+    )
 
-    def c_str(c):
-        r = [c["prompt"]]
-        loras = c["loras"]
+    def lora_str(loras):
+        r = []
         for k in sorted(loras.keys()):
             r.append(k)
             r.append(loras[k]["weight_clip"])
@@ -654,19 +822,26 @@ def control_to_clip_common(clip, schedules, lora_cache=None, cond_cache=None):
                 r.append(val)
         return "".join(str(i) for i in r)
 
+    def c_str(c):
+        return c["prompt"] + lora_str(c["loras"])
+
     def encode(c):
         nonlocal clip
         nonlocal current_loras
         prompt = c["prompt"]
         loras = c["loras"]
         cachekey = c_str(c)
-        cond = cond_cache.get(cachekey)
+        # Input masks and unseeded noise can't be identified by the prompt alone
+        persist = "IMASK(" not in prompt and "NOISE(" not in prompt
+        cond = cond_cache.get(cachekey, persist)
         if cond is None:
             if loras != current_loras:
                 _, clip = apply_loras_from_spec(loras, clip=orig_clip, cache=lora_cache, applied_loras=current_loras)
                 current_loras = loras
-            cond_cache[cachekey] = do_encode(clip, prompt, schedules.defaults, schedules.masks)
-        return cond_cache[cachekey]
+            clip_key = (input_clip, lora_str(loras))
+            cond = pin_conds(do_encode(clip, prompt, schedules.defaults, schedules.masks, clip_key))
+            cond = cond_cache.put(cachekey, cond, persist)
+        return cond
 
     for end_pct, c in schedules:
         interpolations = [
@@ -691,13 +866,13 @@ def control_to_clip_common(clip, schedules, lora_cache=None, cond_cache=None):
         if start_pct < end_pct:
             cond = encode(c)
             # Node functions return lists of cond
-            cond = conditioning_set_values(
-                cond, {"start_percent": round(start_pct, 2), "end_percent": round(end_pct, 2), "prompt": c["prompt"]}
-            )
-            conds.extend(cond)
+            values = {"start_percent": round(start_pct, 2), "end_percent": round(end_pct, 2), "prompt": c["prompt"]}
+            conds.extend([n[0], {**n[1], **values}] for n in cond)
 
         start_pct = end_pct
-        log.debug("Conds at the end: %s", debug_conds(conds))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Conds at the end: %s", debug_conds(conds))
 
-    log.debug("Final cond info: %s", debug_conds(conds))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Final cond info: %s", debug_conds(conds))
     return conds
@@ -1,17 +1,23 @@
 import torch
 
+from .utils import tokenize
+
 
 # Copied and adapted from https://github.com/bvhari/ComfyUI_PerpWeight/blob/main/clipperpweight.py
 def perp_encode(clip, tokens):
-    empty_tokens = clip.tokenize("")
+    empty_tokens = tokenize(clip, "")
     sdxl_flag = "g" in tokens
-    empty_cond, empty_cond_pooled = clip.encode_from_tokens(empty_tokens, return_pooled=True)
     unweighted_tokens = {}
     for k in ["l", "g"]:
         if k not in tokens:
             continue
         unweighted_tokens[k] = [[(t, 1.0) for t, _ in x] for x in tokens[k]]
-    unweighted_cond, unweighted_pooled = clip.encode_from_tokens(unweighted_tokens, return_pooled=True)
+        # Encode the empty prompt as an extra chunk in the same batch instead of doing a separate pass.
+        # It goes last since the pooled output comes from the first chunk
+        unweighted_tokens[k].append(empty_tokens[k][0])
+    cond, unweighted_pooled = clip.encode_from_tokens(unweighted_tokens, return_pooled=True)
+    n = len(empty_tokens["g" if sdxl_flag else "l"][0])
+    unweighted_cond, empty_cond = cond[:, :-n], cond[:, -n:]
     cond = torch.clone(unweighted_cond)
 
     if sdxl_flag:
@@ -1,7 +1,12 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from os import environ
 from math import lcm
+from pathlib import Path
+import hashlib
+import json
+import os
 import time
+import weakref
 import logging
 import torch
 
@@ -14,6 +19,12 @@ import comfy.model_management
 log = logging.getLogger("comfyui-prompt-control-legacy")
 
 FORCE_CPU_OFFLOAD = bool(environ.get("COMFYUI_PC_CPU_OFFLOAD"))
+BF16_ENCODE = bool(environ.get("PC_BF16_ENCODE"))
+DISK_COND_CACHE = bool(environ.get("PC_DISK_COND_CACHE"))
+DISK_COND_CACHE_DIR = environ.get("PC_DISK_COND_CACHE_DIR", Path.home() / ".cache" / "comfyui-prompt-control")
+DISK_COND_CACHE_SIZE = int(environ.get("PC_DISK_COND_CACHE_SIZE", 1000))
+# Bump when the cached format or encoding behaviour changes
+DISK_COND_CACHE_VERSION = 1
 
 
 # Minimal Modelpatcher that doesn't do anything, for LoRA loading when not
@@ -61,7 +72,37 @@ def equalize(*tensors):
 
     x = lcm(*(t.shape[1] for t in tensors))
 
-    return (t.repeat(1, x // t.shape[1], 1) for t in tensors)
+    # Tensors that are already the right length don't need to be copied
+    return tuple(t if t.shape[1] == x else t.repeat(1, x // t.shape[1], 1) for t in tensors)
+
+
+def pin_conds(conds):
+    """Pins CPU tensors in conds so that they can be copied to the GPU asynchronously"""
+    if comfy.model_management.get_torch_device().type != "cuda":
+        return conds
+
+    def pin(t):
+        if isinstance(t, torch.Tensor) and t.device.type == "cpu" and not t.is_pinned():
+            return t.pin_memory()
+        return t
+
+    return [[pin(c), {k: pin(v) for k, v in s.items()}] for c, s in conds]
+
+
+TOKEN_CACHE = weakref.WeakKeyDictionary()
+
+
+def tokenize(clip, text, return_word_ids=False):
+    """Tokenize text, caching the results per tokenizer and tokenizer options. Returns a copy that is safe to modify.
+    Because of the cache, embedding: files are only looked up once per process"""
+    cache = TOKEN_CACHE.setdefault(clip.tokenizer, LRUCache(1024))
+    # Clones share the tokenizer object but can have different options
+    options = tuple(sorted(getattr(clip, "tokenizer_options", {}).items()))
+    key = (text, return_word_ids, options)
+    tokens = cache.get(key)
+    if tokens is None:
+        tokens = cache.put(key, clip.tokenize(text, return_word_ids=return_word_ids))
+    return {k: [list(group) for group in v] if isinstance(v, list) else v for k, v in tokens.items()}
 
 
 def unpatch_model(model):
@@ -263,3 +304,128 @@ class Timer:
         elapsed = time.time() - self.start
         if environ.get("PC_SHOW_TIMINGS"):
             log.info("Executed %s in %s seconds", self.name, elapsed)
+
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        if key not in self.data:
+            return None
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+        return value
+
+
+class DiskCondCache:
+    """Wraps an in-memory cond cache and persists entries to disk as safetensors files.
+    Settings that aren't tensors are stored as JSON in the safetensors metadata"""
+
+    def __init__(
+        self, cache, fingerprint, enabled=DISK_COND_CACHE, path=DISK_COND_CACHE_DIR, size=DISK_COND_CACHE_SIZE
+    ):
+        self.cache = cache
+        # Callable, so that fingerprinting is only done if the disk cache is actually used
+        self.fingerprint = fingerprint
+        self.enabled = enabled
+        self.path = Path(path)
+        self.size = size
+        self._salt = None
+        # Number of files in the cache directory, counted on the first save
+        self._count = None
+
+    def _file(self, cachekey):
+        if self._salt is None:
+            self._salt = self.fingerprint()
+        key = hashlib.blake2b(f"v{DISK_COND_CACHE_VERSION}{cachekey}".encode() + self._salt).hexdigest()
+        return self.path / f"{key}.st"
+
+    def get(self, cachekey, persist=True):
+        cond = self.cache.get(cachekey)
+        if cond is None and self.enabled and persist:
+            cond = self._load(self._file(cachekey))
+            if cond is not None:
+                cond = self.cache[cachekey] = pin_conds(cond)
+        return cond
+
+    def put(self, cachekey, cond, persist=True):
+        self.cache[cachekey] = cond
+        if self.enabled and persist:
+            self._save(self._file(cachekey), cond)
+        return cond
+
+    def _load(self, f):
+        from safetensors import safe_open
+
+        if not f.exists():
+            return None
+        try:
+            with safe_open(f, framework="pt") as st:
+                settings = json.loads(st.metadata()["settings"])
+                conds = []
+                for i, s in enumerate(settings):
+                    for k, v in s.items():
+                        if isinstance(v, dict) and "tuple" in v:
+                            s[k] = tuple(v["tuple"])
+                    for k in st.keys():
+                        idx, name = k.split(".", 1)
+                        if int(idx) == i and name != "cond":
+                            s[name] = st.get_tensor(k)
+                    conds.append([st.get_tensor(f"{i}.cond"), s])
+            os.utime(f)
+        except Exception as e:
+            log.warning("Failed to load cached cond from %s: %s", f, e)
+            return None
+        log.debug("Loaded cond from disk cache: %s", f)
+        return conds
+
+    def _save(self, f, conds):
+        from safetensors.torch import save_file
+
+        tensors = {}
+        settings = []
+        for i, (cond, s) in enumerate(conds):
+            tensors[f"{i}.cond"] = cond.detach().cpu().contiguous().clone()
+            meta = {}
+            for k, v in s.items():
+                if isinstance(v, torch.Tensor):
+                    tensors[f"{i}.{k}"] = v.detach().cpu().contiguous().clone()
+                elif isinstance(v, tuple):
+                    meta[k] = {"tuple": list(v)}
+                else:
+                    meta[k] = v
+            settings.append(meta)
+        try:
+            metadata = {"settings": json.dumps(settings)}
+        except TypeError as e:
+            log.debug("Not caching cond to disk, settings not serializable: %s", e)
+            return
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp = f.with_suffix(".tmp")
+            exists = f.exists()
+            save_file(tensors, tmp, metadata=metadata)
+            os.replace(tmp, f)
+            if self._count is None:
+                self._count = sum(1 for _ in self.path.glob("*.st"))
+            elif not exists:
+                self._count += 1
+            if self._count > self.size:
+                self._evict()
+        except OSError as e:
+            log.warning("Failed to write cond cache file %s: %s", f, e)
+
+    def _evict(self):
+        files = sorted(self.path.glob("*.st"), key=lambda f: f.stat().st_mtime)
+        for f in files[: max(len(files) - self.size, 0)]:
+            log.debug("Evicting cond cache file %s", f)
+            f.unlink(missing_ok=True)
+        self._count = min(len(files), self.size)